@@ -54,7 +54,10 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
-from threading import Lock, Thread, current_thread
+import heapq
+from collections import deque
+from itertools import count
+from threading import Condition, Lock, Thread, current_thread
 from time import time, sleep
 from datetime import datetime
 from types import FunctionType
@@ -86,6 +89,8 @@ class QueueCommandError(Exception):
 
 class QueueCommand:
     """ Represents a queued command, this is an internal object and should not be called directly """
+    __slots__ = ('expire_time', 'command_func', 'finished_callback', 'args', 'kwargs', 'timestamp', 'delay', 'ret_value', 'run_after', '_lock')
+
     def __init__(self, max_age:int, command_func:Callable, kwargs:dict, args:list, delay:int=0, finished_callback=None, run_after=None):
         """ Create an object for the queue, this is an internal object and should not be called directly """
         self.expire_time = time() + max_age
@@ -107,7 +112,7 @@ class QueueCommand:
 
     def __str__(self) -> str:
         """ return the object as a string """
-        return f"function: {self.command_func.__name__}, timestamp: {round(self.timestamp, 0)}, expire in: {round(self.expire_time - time(), 2)}, run after: {self.run_after}, " \
+        return f"function: {getattr(self.command_func, '__name__', repr(self.command_func))}, timestamp: {round(self.timestamp, 0)}, expire in: {round(self.expire_time - time(), 2)}, run after: {self.run_after}, " \
             f"expire-time: {self.expire_time}, kwargs: {str(self.kwargs)[0:60]}{'...' if len(str(self.kwargs))> 60 else ''}, args: {str(self.args)[0:60]}{'...' if len(str(self.args))>60 else ''}"
 
     @property
@@ -157,7 +162,7 @@ class QueueManager:
         (readonly)
     """
     def __init__(self, name:str, command_func:Callable, depth:int=5, delay_ms:int=50, max_age:int=5, timeout:int=5, log_level=INFO, \
-                 callback_func=None, raise_queue_full=False):
+                 callback_func=None, raise_queue_full=False, executor=None):
         ''' Init a Queue Manager class.
         Parameters
         ----------
@@ -182,6 +187,10 @@ class QueueManager:
                 (default False)  NOTE: If queue is full, the new item is dropped 
             log_level : str
                 Logging level to use (default INFO)
+            executor : concurrent.futures.Executor|None
+                OPTIONAL - Executor to run the queue processing loop on instead of a
+                dedicated thread per queue. Lets multiple queues share a pool and
+                avoids a thread create/destroy per processing burst. (default None)
         '''
         self._logger = create_logger(log_level, name=f'Queue-{name}')
         try:
@@ -197,13 +206,19 @@ class QueueManager:
         self.timeout = timeout # Command timeout in seconds
         self.command_func = command_func # Default function to call if a specific function is not provided with the add
         self.callback_func = callback_func # Function to call after a command is completed
-        self._queue = [] # list to hold the commands in queue
+        self._ready = deque() # commands ready to run now - deque append/popleft are GIL-atomic so the fast path needs no lock
+        self._delayed = [] # min-heap of (run_after, seq, command) - earliest delayed command on top, seq keeps FIFO order for ties
+        self._seq = count() # monotonic sequence number for heap ordering
         self._lock = Lock()
+        self._cond = Condition(self._lock) # wraps the queue lock - notified when delayed commands are added or the queue is cleared
         self._queue_exec_thread = None # object to hold the currently active thread
+        self._exec_active = False # True while an exec thread is running (set/cleared under the lock)
+        self._executor = executor # optional executor to run the processing loop instead of a dedicated thread
         self._logger.info('Queue initialized.')
         self.raise_queue_full = raise_queue_full
         self._delay_queue_check_interval = DELAY_QUEUE_CHECK_INTERVAL
         self._delay_queue_monitor_thread = None
+        self._monitor_active = False # True while a delay monitor thread is running (set/cleared under the lock)
 
     def __del__(self):
         self.close()
@@ -218,18 +233,19 @@ class QueueManager:
             self._logger.critical('Runtime error attempting to close queue: %s', run_err)
             raise QueueCommandError(f'Runtime error attempting to close queue: {run_err}') from run_err
         self._queue_exec_thread = None
-        self._queue = []
+        self._ready = deque()
+        self._delayed = []
 
     @property
     def length(self):
         """ returns the length of the queue in the queue (includes any currently running tasks) """
-        with self._lock:
-            return len(self._queue) + (1 if (isinstance(self._queue_exec_thread, Thread) and self._queue_exec_thread.is_alive()) else 0)
+        # len() on a deque/list and reading the flag are atomic under the GIL - no lock needed
+        return len(self._ready) + len(self._delayed) + (1 if self._exec_active else 0)
 
     @property
     def busy(self):
         """ Returns true if there are any queued commands or commands currently being executed """
-        if (isinstance(self._queue_exec_thread, Thread) and self._queue_exec_thread.is_alive()) or len(self._queue) > 0:
+        if self._exec_active or len(self._ready) > 0 or len(self._delayed) > 0:
             return True
         return False
 
@@ -265,47 +281,159 @@ class QueueManager:
         -------
             None
         """
-        if len(self._queue) < self.depth:
+        if not self._full():
             command_func = command_func if command_func is not None else self.command_func
             command_delay = delay if delay is not None else self.delay
-            with self._lock:
-                self._queue.append(QueueCommand(max_age=self.max_age,
-                                                    command_func=command_func,
-                                                    kwargs=kwargs if kwargs is not None else {},
-                                                    args=args if args is not None else [],
-                                                    delay=command_delay,
-                                                    finished_callback=finished_func if finished_func is not None else self.callback_func,
-                                                    run_after=run_after))
-                if not isinstance(self._queue_exec_thread, Thread) or not self._queue_exec_thread.is_alive():
-                    self._queue_exec_thread = Thread(target=self._queue_exec, name=self.name + '_queue_exec', daemon=True)
-                    self._queue_exec_thread.start()
-                self._logger.debug(f"Added {self._queue[-1]} to queue.")
+            command = QueueCommand(max_age=self.max_age,
+                                   command_func=command_func,
+                                   kwargs=kwargs if kwargs is not None else {},
+                                   args=args if args is not None else [],
+                                   delay=command_delay,
+                                   finished_callback=finished_func if finished_func is not None else self.callback_func,
+                                   run_after=run_after)
+            if command.run_after <= time():
+                # fast path - the deque append is GIL-atomic, only take the lock if the exec thread needs a start
+                self._ready.append(command)
+                if not self._exec_active:
+                    with self._lock:
+                        self._wake_exec()
+            else:
+                with self._cond:
+                    heapq.heappush(self._delayed, (command.run_after, next(self._seq), command))
+                    self._wake_exec()
+                    self._cond.notify_all() # wake the delay monitor in case this run_after is now the earliest
+            self._logger.debug(f"Added {command} to queue.")
         else:
-            self._logger.error(f"Error adding to queue.  Queue full! {command_func} with paramters: {str(args)[0:60]}{'...' if len(str(args)) > 60 else ''}: to queue...")
-            callback_func = finished_func if finished_func is not None else self.callback_func
-            if isinstance(callback_func, Callable):
-                callback_func(None, STATUS_QUEUE_FULL, *args if args is not None else [], **kwargs if kwargs is not None else {})
+            self._reject_full(command_func=command_func, args=args, kwargs=kwargs, finished_func=finished_func)
             if self.raise_queue_full:
                 raise QueueCommandError(f"Error adding to queue.  Queue full! {command_func} with paramters:" \
                     + f" {str(args)[0:60]}{'...' if len(str(args)) > 60 else ''}: to queue...")
 
+    def add_many(self, items):
+        """
+        Add multiple commands to the queue in a single pass
+
+        The queue lock is only acquired once for the whole batch and the
+        processing thread is started once, rather than per item as with add().
+
+        Parameters
+        ----------
+            items : list
+                List of dicts, each dict holding the same keys that add() accepts
+                (command_func, args, kwargs, delay, finished_func, run_after).
+                Missing keys fall back to the queue defaults.
+
+        Raises
+        ------
+            QueueCommandError
+                IF raise_queue_full is set to True, QueueCommandError will be raised
+                after the batch is processed if any item was dropped because the
+                queue was full. The finished callback for each dropped item is
+                still called with STATUS_QUEUE_FULL.
+
+        Returns
+        -------
+            None
+        """
+        rejected = []
+        with self._lock:
+            for item in items:
+                if not self._full():
+                    command_delay = item.get('delay')
+                    command = QueueCommand(max_age=self.max_age,
+                                           command_func=item.get('command_func') if item.get('command_func') is not None else self.command_func,
+                                           kwargs=item.get('kwargs') if item.get('kwargs') is not None else {},
+                                           args=item.get('args') if item.get('args') is not None else [],
+                                           delay=command_delay if command_delay is not None else self.delay,
+                                           finished_callback=item.get('finished_func') if item.get('finished_func') is not None else self.callback_func,
+                                           run_after=item.get('run_after'))
+                    if command.run_after <= time():
+                        self._ready.append(command)
+                    else:
+                        heapq.heappush(self._delayed, (command.run_after, next(self._seq), command))
+                else:
+                    rejected.append(item)
+            if len(self._ready) > 0 or len(self._delayed) > 0:
+                self._wake_exec()
+            if len(self._delayed) > 0:
+                self._cond.notify_all() # wake the delay monitor in case an earlier run_after arrived
+            self._logger.debug('Added %s of %s items to queue.', len(items) - len(rejected), len(items))
+        for item in rejected:
+            self._reject_full(command_func=item.get('command_func'), args=item.get('args'), kwargs=item.get('kwargs'), finished_func=item.get('finished_func'))
+        if len(rejected) > 0 and self.raise_queue_full:
+            raise QueueCommandError(f"Error adding to queue.  Queue full! Dropped {len(rejected)} of {len(items)} items.")
+
+    def _full(self):
+        ''' Return True if the queue is at its configured depth. The queue NEVER buffers
+        beyond depth - overflow commands are rejected at admission so memory stays O(depth)
+        no matter how fast callers submit '''
+        return len(self._ready) + len(self._delayed) >= self.depth
+
+    def _reject_full(self, command_func, args, kwargs, finished_func):
+        ''' Log and run the finished callback with STATUS_QUEUE_FULL for a command rejected because the queue is full '''
+        self._logger.error(f"Error adding to queue.  Queue full! {command_func} with paramters: {str(args)[0:60]}{'...' if len(str(args)) > 60 else ''}: to queue...")
+        callback_func = finished_func if finished_func is not None else self.callback_func
+        if isinstance(callback_func, Callable):
+            callback_func(None, STATUS_QUEUE_FULL, *args if args is not None else [], **kwargs if kwargs is not None else {})
+
     def clear(self):
         """ Clears the current queue """
-        if len(self._queue) > 0:
-            self._logger.info(f"Clearing queue with {len(self._queue)} items...")
-            with self._lock:
-                self._queue = []
+        if len(self._ready) > 0 or len(self._delayed) > 0:
+            self._logger.info(f"Clearing queue with {len(self._ready) + len(self._delayed)} items...")
+            with self._cond:
+                self._ready = deque()
+                self._delayed = []
+                self._cond.notify_all() # let the delay monitor exit right away
+
+    def _wake_exec(self):
+        """ Start the queue exec thread if one is not already running. The caller MUST hold the queue lock """
+        if not self._exec_active:
+            self._exec_active = True
+            if self._executor is not None:
+                self._queue_exec_thread = None
+                self._executor.submit(self._queue_exec)
+            else:
+                self._queue_exec_thread = Thread(target=self._queue_exec, name=self.name + '_queue_exec', daemon=True)
+                self._queue_exec_thread.start()
+
+    def _wake_monitor(self):
+        """ Start the delay queue monitor thread if one is not already running. The caller MUST hold the queue lock """
+        if not self._monitor_active:
+            self._monitor_active = True
+            self._delay_queue_monitor_thread = Thread(target=self._delay_queue_monitor, name=self.name + '_delay_monitor', daemon=True)
+            self._delay_queue_monitor_thread.start()
 
     def _queue_exec(self):
         """ Starts a background thread to process and send all queued commands """
-        if len(self._queue) > 0:
-            self._logger.debug('Exec queue thread starting...')
-        while len(self._queue) > 0:
-            with self._lock:
-                if len(self._queue) == 0:
-                    # catch the case where the queue is cleared after the loop enters but before we pop
-                    return
-                queue_temp = self._queue.pop(0)
+        self._logger.debug('Exec queue thread starting...')
+        while True:
+            now = time()
+            if len(self._delayed) > 0:
+                with self._lock:
+                    # promote delayed commands that are now ready
+                    while len(self._delayed) > 0 and self._delayed[0][0] <= now:
+                        self._ready.append(heapq.heappop(self._delayed)[2])
+            try:
+                # single consumer - the popleft does not need the lock
+                queue_temp = self._ready.popleft()
+            except IndexError:
+                with self._lock:
+                    if len(self._ready) > 0:
+                        # a command was added between the popleft and taking the lock
+                        continue
+                    self._exec_active = False
+                    if len(self._delayed) > 0:
+                        # only delayed commands are left - hand off to the delay queue monitor
+                        self._wake_monitor()
+                # re-check after releasing the lock: add()'s fast path reads _exec_active without
+                # the lock, so a producer may have appended while this thread was going idle and
+                # seen a stale True. Either this re-check sees the command and re-wakes, or the
+                # producer's read happened after the store above and sees False and wakes itself.
+                if len(self._ready) > 0:
+                    with self._lock:
+                        self._wake_exec()
+                self._logger.debug('Exec Queue thread ending.')
+                return
             if queue_temp.expired:
                 self._logger.error(f"Queue item exired: {queue_temp}")
                 try:
@@ -315,15 +443,6 @@ class QueueManager:
                 # skip to the next item
                 continue
 
-            # check if the task is set with a delayed execution
-            if queue_temp.delay_run:
-                with self._lock:
-                    # add the task to the end of the queue - NOTE: Don't check the length!  it was already queued, just add it
-                    self._logger.debug('Delaying execution for %s', queue_temp)
-                    self._queue.append(queue_temp)
-                    # skip to the next item
-                    continue
-
             self._logger.debug(f"Executing queue for: {queue_temp}")
             try:
                 exec_thread = Thread(target=queue_temp.execute, name=self.name + '_queue_exec', daemon=True)
@@ -354,42 +473,27 @@ class QueueManager:
                 self._logger.error('Runtime error attempting to run queue command %s with kwargs %s, args %s: %s', queue_temp.command_func, str(queue_temp.kwargs)[0:60],
                                    str(queue_temp.args)[0:60], run_err)
 
-            # check and see if there are any items queued that are not delayed execution. If so, continue on
-            with self._lock:
-                continue_processing = False
-                for queue_item in self._queue:
-                    if not queue_item.delay_run:
-                        continue_processing = True
-                        break
-                if continue_processing:
-                    continue
-
-            # if only delayed items are left, start a delayed processing thread
-            with self._lock:
-                if not isinstance(self._delay_queue_monitor_thread, Thread) or not self._delay_queue_monitor_thread.is_alive():
-                    self._delay_queue_monitor_thread = Thread(target=self._delay_queue_monitor, name=self.name + '_delay_monitor', daemon=True)
-                    self._delay_queue_monitor_thread.start()
-            # end the queue thread, handing off to delay queue monitor
-            self._logger.debug('Exec Queue thread ending.')
-            return
-
     def _delay_queue_monitor(self):
-        ''' Background thread to monitor the queue for threads with a delayed execution time. If there are tasks ready to run, start the queue thread '''
-        if len(self._queue) > 0:
+        ''' Background thread to monitor the queue for commands with a delayed execution time. If there are tasks ready to run, start the queue thread '''
+        if len(self._delayed) > 0:
             self._logger.debug('Delay queue monitor thread starting...')
-        while len(self._queue) > 0:
-            # delay before checking
-            sleep(self._delay_queue_check_interval)
-
-            # check for items that are ready to execute
-            start_queue_thread = False
+        with self._cond:
+            while len(self._delayed) > 0:
+                # wait until the earliest run_after time (capped at the check interval) - a notify
+                # from add()/add_many()/clear() wakes the wait early if the queue changes
+                self._cond.wait(timeout=min(max(self._delayed[0][0] - time(), 0.1), self._delay_queue_check_interval))
+
+                # check for items that are ready to execute
+                if len(self._delayed) > 0 and self._delayed[0][0] <= time():
+                    self._logger.debug('Waking queue exec thread for delayed tasks...')
+                    self._wake_exec()
+            self._monitor_active = False
+
+        # re-check after releasing the lock with the flag cleared: the exec thread starts the
+        # monitor under the lock, but a delayed command can arrive while this thread is exiting.
+        # Either this re-check sees it and restarts the monitor, or the exec thread's
+        # _monitor_active read happened after the store above and starts a fresh one.
+        if len(self._delayed) > 0:
             with self._lock:
-                if False in [x.delay_run for x in self._queue]:
-                    start_queue_thread = True
-                    if start_queue_thread:
-                        if not isinstance(self._queue_exec_thread, Thread) or not self._queue_exec_thread.is_alive():
-                            self._logger.debug('Waking queue exec thread for delayed tasks...')
-                            self._queue_exec_thread = Thread(target=self._queue_exec, name=self.name + '_queue_exec', daemon=True)
-                            self._queue_exec_thread.start()
-
+                self._wake_monitor()
         self._logger.debug('Delay queue monitor thread ending.')
\ No newline at end of file
@@ -1,154 +1,241 @@
+import logging
 import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from time import sleep
-from threading import Lock
+from threading import Event, Lock
+import numpy as np
 from logging_handler import create_logger, INFO, DEBUG, WARNING, CRITICAL
 import queue_processor
 from time import time
 
 LOG_LEVEL = CRITICAL
 
+# single shared logger for TestObj - at the CRITICAL default a NullHandler logger is
+# used so nothing is formatted or emitted per instance / per iteration; flipping
+# LOG_LEVEL to DEBUG swaps in a real configured logger so the messages show up
+if LOG_LEVEL == DEBUG:
+    _LOGGER = create_logger(LOG_LEVEL, name='queue_test')
+else:
+    _LOGGER = logging.getLogger('queue_test.null')
+    _LOGGER.addHandler(logging.NullHandler())
+    _LOGGER.setLevel(LOG_LEVEL)
+    _LOGGER.propagate = False
+_DEBUG_ENABLED = _LOGGER.isEnabledFor(logging.DEBUG)
+
+# shared pool for the queue processing loops - pre-warmed workers instead of a
+# pthread create/destroy per processing burst (at most 2 queues drain at once here)
+_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='qp')
+
+
+def _make_ok_immediate(complete):
+    ''' Build a closure over the complete array for the hot ok_immediate path. A compiled
+    extension was considered for these trivial callbacks, but this package is pure Python;
+    a closure gets most of the win by replacing the self attribute lookup and method
+    dispatch per call with a single captured-array store '''
+    def ok_immediate(iteration, ret_value=True):
+        complete[iteration] = True
+        return ret_value
+    return ok_immediate
+
 class TestObj:
     ''' Class to hold the test info '''
     def __init__(self, name, queue_depth, items_to_queue, call_func, finished_func=None, ret_value=True, delay_ms=50, max_age=5, timeout=5, 
-                 clear=False, delay_times=None):
-        self.queue = queue_processor.QueueManager(name=name, depth=queue_depth,
-                                                  command_func=getattr(self, call_func),
-                                                  callback_func=getattr(self, finished_func) if finished_func is not None else None,
-                                                  delay_ms=delay_ms,
-                                                  max_age=max_age,
-                                                  timeout=timeout,
-                                                  log_level=LOG_LEVEL)
-        self.queue_data = [{'started': False, 'complete': False, 'callback': False, 'status': None, 'error': False} for x in range(items_to_queue)]
-        self._lock = Lock()
-        self._logger = create_logger(LOG_LEVEL)
-        for x in range(items_to_queue):
-            self.queue.add(args=[x, ret_value], run_after=time() + delay_times[x] if delay_times is not None else None)
-            with self._lock:
-                self.queue_data[x]['started'] = True
+                 clear=False, delay_times=None, queue=None, use_add=False, executor=_POOL, no_callback=False):
+        # per-iteration state is stored struct-of-arrays style so the check methods
+        # can use vectorized numpy operations instead of scanning a list of dicts
+        self._complete = np.zeros(items_to_queue, dtype=np.bool_)
+        self._error = np.zeros(items_to_queue, dtype=np.bool_)
+        self._callback = np.full(items_to_queue, False, dtype=object)
+        self._status = np.full(items_to_queue, None, dtype=object)
+        self._summary_cache = None
+        self._status_counts = Counter() # maintained on-write by _finished - one increment per item
+        self._logger = _LOGGER
+        # every item gets exactly one finished callback (OK/EXCEPTION/TIMEOUT/EXPIRED
+        # or QUEUE_FULL), so count them down and signal when the last one fires.
+        # With no_callback the queue runs with callback_func=None (the library's
+        # no-callback configuration) and the wait relies on the length fallback.
+        self._finished_func = partial(getattr(TestObj, finished_func), self) if finished_func is not None else None
+        self._remaining = items_to_queue
+        self._count_lock = Lock()
+        self._done = Event()
+        if call_func == 'ok_immediate' and not _DEBUG_ENABLED:
+            command_func = _make_ok_immediate(self._complete)
+        else:
+            command_func = partial(getattr(TestObj, call_func), self)
+        if queue is not None:
+            # reuse a long-lived shared QueueManager - repoint its defaults at this test
+            # instead of paying queue/logger/thread startup per TestObj
+            self.queue = queue
+            self.queue.depth = queue_depth
+            self.queue.delay = delay_ms
+            self.queue.max_age = max_age
+            self.queue.timeout = timeout
+            self.queue.command_func = command_func
+            self.queue.callback_func = None if no_callback else self._finished
+        else:
+            self.queue = queue_processor.QueueManager(name=name, depth=queue_depth,
+                                                      command_func=command_func,
+                                                      callback_func=None if no_callback else self._finished,
+                                                      delay_ms=delay_ms,
+                                                      max_age=max_age,
+                                                      timeout=timeout,
+                                                      log_level=LOG_LEVEL,
+                                                      executor=executor)
+        # single time() call plus one vectorized add instead of one of each per item
+        run_after = time() + np.asarray(delay_times, dtype=np.float64) if delay_times is not None else None
+        if use_add:
+            # submit one at a time through the public add() API
+            for x in range(items_to_queue):
+                self.queue.add(args=[x, ret_value], run_after=run_after[x] if run_after is not None else None)
+        elif run_after is not None:
+            self.queue.add_many([{'args': [x, ret_value], 'run_after': run_after[x]} for x in range(items_to_queue)])
+        else:
+            self.queue.add_many([{'args': [x, ret_value]} for x in range(items_to_queue)])
 
         # test clearing the queue
         if clear:
             self._logger.info('Clearing the queue...')
             self.queue.clear()
 
-        # wait until the queue is empty
-        while True:
-            sleep(1)
+        # wait until every item reports a finished callback - fall back to checking
+        # the queue length so a cleared queue (dropped items never call back) still returns
+        while not self._done.wait(timeout=1):
             if self.queue.length == 0:
                 return
 
+    def _finished(self, ret_value, status, *args, **kwargs):
+        ''' Queue callback wrapper - runs the test callback (if any) then counts the item as finished '''
+        if self._finished_func is not None:
+            self._finished_func(ret_value, status, *args, **kwargs)
+        with self._count_lock:
+            self._status_counts[status] += 1
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._done.set()
+
     def ok_immediate(self, iteration, ret_value=True):
-        self._logger.debug(f"Iteration {iteration} complete")
-        with self._lock:
-            self.queue_data[iteration]['complete'] = True
+        if _DEBUG_ENABLED:
+            self._logger.debug(f"Iteration {iteration} complete")
+        self._complete[iteration] = True
         return ret_value
 
     def ok_delay(self, iteration, delay=3, ret_value=True):
         sleep(delay)
-        self._logger.debug(f"Iteration {iteration} complete")
-        with self._lock:
-            self.queue_data[iteration]['complete'] = True
+        if _DEBUG_ENABLED:
+            self._logger.debug(f"Iteration {iteration} complete")
+        self._complete[iteration] = True
         return ret_value
 
     def callback(self, ret_value, status, iteration, *args, **kwargs):
-        self._logger.debug(f"Iteration {iteration} CALLBACK, return: {ret_value}, status: {status}")
-        with self._lock:
-            self.queue_data[iteration]['callback'] = ret_value
-            self.queue_data[iteration]['status'] = status
+        if _DEBUG_ENABLED:
+            self._logger.debug(f"Iteration {iteration} CALLBACK, return: {ret_value}, status: {status}")
+        self._callback[iteration], self._status[iteration] = ret_value, status
 
     def no_end(self, iteration, ret_value=True):
-        self._logger.debug(f"Iteration {iteration} will now hang...")
+        if _DEBUG_ENABLED:
+            self._logger.debug(f"Iteration {iteration} will now hang...")
         sleep(9999)
 
     def fail_return(self, iteration, ret_value=False):
         ''' Sample function that returns a failed status '''
-        with self._lock:
-            self.queue_data[iteration]['complete'] = True
-        self._logger.debug(f"Iteration {iteration} returning a fail...")
+        self._complete[iteration] = True
+        if _DEBUG_ENABLED:
+            self._logger.debug(f"Iteration {iteration} returning a fail...")
         return ret_value
 
     def fail_raise(self, iteration, ret_value=False):
         ''' Sample function that raises an exception '''
-        self._logger.debug(f"Iteration {iteration} will now raise an error...")
+        if _DEBUG_ENABLED:
+            self._logger.debug(f"Iteration {iteration} will now raise an error...")
         raise ValueError(f"Iteration {iteration} value error")
 
     def tests_passed(self, iterations=None):
         ''' Return True if passed iterations were successful '''
-        if iterations is None:
-            iterations = list(range(len(self.queue_data)))
-        for x in iterations:
-            if not self.queue_data[x].get('complete') or self.queue_data[x].get('error'):
-                self._logger.error(f"Iteration {x} should have passed: {self.queue_data[x]}")
-                return False
-        return True
+        complete = self._complete if iterations is None else self._complete[iterations]
+        error = self._error if iterations is None else self._error[iterations]
+        if bool(complete.all() and not error.any()):
+            return True
+        self._logger.error(f"Iterations that should have passed: {np.flatnonzero(~complete | error)}")
+        return False
 
     def tests_callback(self, iterations=None, value=True):
         ''' Return True if passed iterations have passed value as a callback '''
-        if iterations is None:
-            iterations = list(range(len(self.queue_data)))
-        for x in iterations:
-            if self.queue_data[x].get('callback') != value:
-                return False
-        return True
+        callback = self._callback if iterations is None else self._callback[iterations]
+        return bool((callback == value).all())
 
     def tests_status(self, iterations=None, status=None):
         ''' Return True if passed iterations have passed value as a callback '''
-        if iterations is None:
-            iterations = list(range(len(self.queue_data)))
-        for x in iterations:
-            if self.queue_data[x].get('status') != status:
-                return False
-        return True
+        status_arr = self._status if iterations is None else self._status[iterations]
+        return bool((status_arr == status).all())
+
+    def _summary(self):
+        ''' Compute the pass/fail totals in a single pass over the arrays.
+        Cached - the state is final by the time the checks run. '''
+        if self._summary_cache is None:
+            passed = self._complete & ~self._error
+            self._summary_cache = (int(passed.sum()), int((~passed).sum()))
+        return self._summary_cache
 
     def status_count(self, status):
         ''' Return a count matching the status '''
-        return len([x for x in self.queue_data if x.get('status') == status])
+        return self._status_counts[status]
 
     @property
     def passed_count(self):
-        return len([x for x in self.queue_data if x.get('complete') and not x.get('error')])
+        return self._summary()[0]
 
     def tests_failed(self, iterations=None):
         ''' Return True if passed iterations failed '''
-        if iterations is None:
-            iterations = list(range(len(self.queue_data)))
-        for x in iterations:
-            if self.queue_data[x].get('complete'):
-                self._logger.error(f"Iteration {x} should have failed: {self.queue_data[x]}")
-                return False
-        return True
+        complete = self._complete if iterations is None else self._complete[iterations]
+        if not complete.any():
+            return True
+        self._logger.error(f"Iterations that should have failed: {np.flatnonzero(complete)}")
+        return False
 
     @property
     def failed_count(self):
-        return len([x for x in self.queue_data if x.get('error') or not x.get('complete')])
+        return self._summary()[1]
 
 
 class QueueTester(unittest.TestCase):
     ''' Exceute the unit tests in the queue processor class '''
+    @classmethod
+    def setUpClass(cls):
+        ''' Create long lived QueueManagers shared by tests 1-3 (one per TestObj in each test) to amortize queue startup '''
+        cls.shared_queue_1 = queue_processor.QueueManager(name='shared-no-finished', command_func=None, log_level=LOG_LEVEL, executor=_POOL)
+        cls.shared_queue_2 = queue_processor.QueueManager(name='shared-w-finished', command_func=None, log_level=LOG_LEVEL, executor=_POOL)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.shared_queue_1.close()
+        cls.shared_queue_2.close()
+
     def test_1_queue_10_ok(self):
         ''' Create queue and queue up 10 items without a finished function, wait for completion and run again with a finished function '''
         count = 10
-        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate')
+        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', queue=self.shared_queue_1)
         self.assertTrue(test1.tests_passed())
-        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback')
+        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback', queue=self.shared_queue_2)
         self.assertTrue(test2.tests_passed())
         self.assertTrue(test2.status_count(queue_processor.STATUS_OK) == count)
 
     def test_2_queue_100_ok(self):
         ''' Create queue and queue up 100 items without a finished function, wait for completion and run again with a finished function '''
         count = 100
-        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', max_age=10)
+        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', max_age=10, queue=self.shared_queue_1)
         self.assertTrue(test1.tests_passed())
-        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback', max_age=10)
+        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback', max_age=10, queue=self.shared_queue_2)
         self.assertTrue(test2.tests_passed())
         self.assertTrue(test2.status_count(queue_processor.STATUS_OK) == count)
 
     def test_3_queue_1000_ok(self):
         ''' Create queue and queue up 1000 items without a finished function, wait for completion and run again with a finished function '''
         count = 1000
-        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', delay_ms=0)
+        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', delay_ms=0, queue=self.shared_queue_1)
         self.assertTrue(test1.tests_passed())
-        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback', delay_ms=0)
+        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback', delay_ms=0, queue=self.shared_queue_2)
         self.assertTrue(test2.tests_passed())
         self.assertTrue(test2.status_count(queue_processor.STATUS_OK) == count)
 
@@ -157,10 +244,10 @@ class QueueTester(unittest.TestCase):
         count = 1000
         queue_depth = 10
         test1 = TestObj(name='test1-no-finished', queue_depth=queue_depth, items_to_queue=count, call_func='ok_immediate')
-        self.assertTrue(test1.tests_passed(list(range(queue_depth))))
+        self.assertTrue(test1.tests_passed(range(queue_depth)))
         self.assertTrue(test1.passed_count <= 20)
         test2 = TestObj(name='test2-w-finished', queue_depth=queue_depth, items_to_queue=count, call_func='ok_immediate', finished_func='callback')
-        self.assertTrue(test2.tests_passed(list(range(queue_depth))))
+        self.assertTrue(test2.tests_passed(range(queue_depth)))
         self.assertTrue(test2.status_count(queue_processor.STATUS_QUEUE_FULL) >= queue_depth)
         self.assertTrue(test2.passed_count <= 20)
 
@@ -173,7 +260,7 @@ class QueueTester(unittest.TestCase):
         test1 = TestObj(name='test1-no-finished', queue_depth=queue_depth, items_to_queue=count, call_func='no_end', max_age=max_age, timeout=timeout)
         self.assertTrue(test1.passed_count == 0)
         test2 = TestObj(name='test2-w-finished', queue_depth=queue_depth, items_to_queue=count, call_func='no_end', finished_func='callback', max_age=max_age, timeout=timeout)
-        sleep(3) # wait for last timeout callback
+        test2._done.wait(timeout=5) # wait for last timeout callback
         self.assertTrue(test2.status_count(queue_processor.STATUS_TIMEOUT) == count)
 
     def test_6_queue_10_fail_raise(self):
@@ -185,7 +272,7 @@ class QueueTester(unittest.TestCase):
         test1 = TestObj(name='test1-no-finished', queue_depth=queue_depth, items_to_queue=count, call_func='fail_raise', max_age=max_age, timeout=timeout)
         self.assertTrue(test1.passed_count == 0)
         test2 = TestObj(name='test2-w-finished', queue_depth=queue_depth, items_to_queue=count, call_func='fail_raise', finished_func='callback', max_age=max_age, timeout=timeout)
-        sleep(3) # wait for last timeout callback
+        test2._done.wait(timeout=5) # wait for last timeout callback
         self.assertTrue(test2.status_count(queue_processor.STATUS_EXCEPTION) == count)
 
     def test_7_queue_10_fail_return(self):
@@ -197,7 +284,7 @@ class QueueTester(unittest.TestCase):
         test1 = TestObj(name='test1-no-finished', queue_depth=queue_depth, items_to_queue=count, call_func='fail_return', max_age=max_age, timeout=timeout, ret_value=False)
         # self.assertTrue(test1.passed_count == 0) Can't check passed count since we aren't getting a return
         test2 = TestObj(name='test2-w-finished', queue_depth=queue_depth, items_to_queue=count, call_func='fail_return', finished_func='callback', max_age=max_age, timeout=timeout, ret_value=False)
-        sleep(3) # wait for last timeout callback
+        test2._done.wait(timeout=5) # wait for last timeout callback
         self.assertTrue(test2.status_count(queue_processor.STATUS_OK) == count) # STATUS is OK because failure is a return value NOT an exception
         self.assertTrue(test2.tests_callback(None, False)) # check that callback was FALSE
 
@@ -210,7 +297,7 @@ class QueueTester(unittest.TestCase):
         test1 = TestObj(name='test1-no-finished', queue_depth=queue_depth, items_to_queue=count, call_func='ok_delay', max_age=max_age, timeout=timeout, ret_value=False, clear=True)
         self.assertTrue(test1.passed_count <= 2)
         test2 = TestObj(name='test2-w-finished', queue_depth=queue_depth, items_to_queue=count, call_func='ok_delay', finished_func='callback', max_age=max_age, timeout=timeout, ret_value=False, clear=True)
-        sleep(3) # wait for last timeout callback
+        test2._done.wait(timeout=3) # cleared items never call back, so just give any in-flight command time to finish
         self.assertTrue(test2.passed_count <= 2)
 
     def test_9_delay_queue(self):
@@ -233,6 +320,19 @@ class QueueTester(unittest.TestCase):
         self.assertTrue(test2.passed_count == count)
         self.assertTrue(end_time - start_time > delay_times_sorted[0])
 
+    def test_10_queue_add_single(self):
+        ''' Queue items one at a time through add() instead of add_many, immediate and with run_after delays.
+        Runs without the shared pool to cover the default dedicated-thread mode, and with no
+        finished callback at all for test1 to cover the callback_func=None configuration. '''
+        count = 100
+        test1 = TestObj(name='test1-no-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', max_age=10, use_add=True, executor=None,
+                        no_callback=True)
+        self.assertTrue(test1.tests_passed())
+        delay_times = [0, 2] * 50
+        test2 = TestObj(name='test2-w-finished', queue_depth=count, items_to_queue=count, call_func='ok_immediate', finished_func='callback', max_age=10,
+                        delay_times=delay_times, use_add=True, executor=None)
+        self.assertTrue(test2.tests_passed())
+        self.assertTrue(test2.status_count(queue_processor.STATUS_OK) == count)
 
 
 if __name__ == '__main__':